@@ -12,3 +12,30 @@ nat_internal_ip = '192.168.0.254'
 nat_internal_net = '192.168.0.0/16'
 nat_internal_mac = 'a2:00:00:11:22:44'
 
+
+# NAT table limits: maximum number of concurrent mappings, and seconds a mapping
+# may stay unused before its external port is reclaimed. This is also the idle timeout of
+# the mapping's reply flows on the switch, which have no hard timeout so that idling out
+# is what removes them and releases the port
+nat_max_entries = 4096
+nat_entry_ttl = 300
+
+# Lowest external port handed out to NAT mappings (up to 65535)
+nat_port_min = 3000
+
+# Print per-packet debug messages (slows down packet handling considerably)
+nat_debug = False
+
+# Flows recently sent to the switch: how many are remembered, and for how many seconds
+# an identical match is not sent again
+flow_cache_size = 4096
+flow_cache_ttl = 2
+
+# Packets waiting for an ARP reply: how many are kept per IP, and for how many seconds
+arp_pending_max = 64
+arp_pending_timeout = 2
+
+# Flows installed on the switch expire after this many seconds without traffic, or after
+# this many seconds in total
+flow_idle_timeout = 30
+flow_hard_timeout = 300
@@ -1,6 +1,8 @@
-import array
+import collections
 import ipaddress
 import random
+import socket
+import struct
 import time
 
 from ryu.base import app_manager
@@ -8,10 +10,81 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ether, ofproto_v1_0, ofproto_v1_2, ofproto_v1_3
-from ryu.lib.packet import packet, ethernet, ether_types, arp, ipv4, tcp, udp, in_proto
-from ryu.lib import mac, addrconv
+from ryu.lib.packet import packet, ethernet, ether_types, arp, in_proto
+from ryu.lib import mac, addrconv, hub
 
 import nat_config as config
+import nat_kernel
+
+_ETH_ARP = 0x0806
+_ETH_IP = 0x0800
+_ETH_IPV6 = 0x86dd
+
+# Offsets of the variable fields in a serialized Ethernet+ARP frame
+_ETH_DST = slice(0, 6)
+_ETH_SRC = slice(6, 12)
+_ARP_DST_MAC = slice(32, 38)
+_ARP_DST_IP = slice(38, 42)
+
+_IPV4 = struct.Struct('!I')
+
+# Indirect group holding the next hop actions towards the NAT gateway
+_GATEWAY_GROUP_ID = 1
+
+# Builders for the IPv4 5-tuple match of each translated transport protocol. The set of
+# match fields only depends on the protocol, so it is fixed here once.
+_MATCH_BUILDERS = {
+    in_proto.IPPROTO_TCP: lambda parser, src_ip, dst_ip, src_port, dst_port: parser.OFPMatch(
+        eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip,
+        ip_proto=in_proto.IPPROTO_TCP, tcp_src=src_port, tcp_dst=dst_port),
+    in_proto.IPPROTO_UDP: lambda parser, src_ip, dst_ip, src_port, dst_port: parser.OFPMatch(
+        eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip,
+        ip_proto=in_proto.IPPROTO_UDP, udp_src=src_port, udp_dst=dst_port),
+}
+
+def _ip_to_int(ip):
+    '''Converts a dotted-quad IPv4 address to an integer'''
+    return _IPV4.unpack(socket.inet_aton(ip))[0]
+
+def _int_to_ip(ip):
+    '''Converts an integer IPv4 address to dotted-quad'''
+    return socket.inet_ntoa(_IPV4.pack(ip))
+
+def _build_arp_frame(opcode, src_mac, src_ip, dst_mac='00:00:00:00:00:00', dst_ip='0.0.0.0',
+                     eth_dst='ff:ff:ff:ff:ff:ff'):
+    '''Serializes an Ethernet+ARP frame, used as a template for outgoing ARP packets'''
+    eth_packet = ethernet.ethernet(dst=eth_dst,
+                                   src=src_mac,
+                                   ethertype=ether.ETH_TYPE_ARP)
+    arp_packet = arp.arp(hwtype=1,
+                         proto=ether.ETH_TYPE_IP,
+                         hlen=6,
+                         plen=4,
+                         opcode=opcode,
+                         src_mac=src_mac,
+                         src_ip=src_ip,
+                         dst_mac=dst_mac,
+                         dst_ip=dst_ip)
+    new_packet = packet.Packet()
+    new_packet.add_protocol(eth_packet)
+    new_packet.add_protocol(arp_packet)
+    new_packet.serialize()
+    return bytes(new_packet.data)
+
+class FlowState(object):
+    '''A NAT mapping: the internal host behind an external port, and when it was last used'''
+    __slots__ = ('internal_ip', 'internal_port', 'mac', 'port', 'ts', 'peers', 'remotes')
+
+    def __init__(self, internal_ip, internal_port, mac, port, ts):
+        self.internal_ip = internal_ip # int
+        self.internal_port = internal_port
+        self.mac = mac # MAC address of the internal host
+        self.port = port # switch port of the internal host
+        self.ts = ts
+        # tuple(protocol, external ip, external port) of each reply flow installed on the switch
+        self.peers = set()
+        # The same for each outbound flow, which may outlive the reply flow
+        self.remotes = set()
 
 class NatController(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_2.OFP_VERSION]
@@ -20,71 +93,181 @@ class NatController(app_manager.RyuApp):
         '''Initialization of controller code'''
         super().__init__()
 
+        # IP addresses used as keys are stored as integers (see _ip_to_int)
         self.arp_table = {}
         self.switch_table = {}
+        # Key: IP waiting for an ARP reply Value: deque of packets to handle once it arrives
         self.pending_arp = {}
         self.ports_in_use = {}
-        # Key: tuple(ip, port) Value: nat ip (internal/external, need to swap src/dst with this)
-        self.nat_port = 3000
-        self.nat_translation = {}
+        # Key: external port (int) Value: FlowState, least recently used first
+        self.nat_flows = collections.OrderedDict()
+        # Key: tuple(internal ip (int), internal port) Value: external port (int)
+        self.rev_nat = {}
+        # Pool of unused external ports. Ports are allocated from the end, lowest first, and
+        # released ports go back at the front so they are the last to be reused.
+        self.free_ports = collections.deque(range(65535, config.nat_port_min - 1, -1))
+
+        internal_net = ipaddress.ip_network(config.nat_internal_net)
+        self._int_net = int(internal_net.network_address)
+        self._int_mask = int(internal_net.netmask)
+        self._gw_i = _ip_to_int(config.nat_gateway_ip)
+        self._ext_mac_bin = addrconv.mac.text_to_bin(config.nat_external_mac)
+
+        # Key: tuple(src mac, dst mac, parser id) Value: list of next hop actions
+        self._next_hop_cache = {}
+        # Key: switch id Value: tuple(gateway mac, gateway port) installed in the gateway group
+        self.gateway_groups = {}
+
+        # Key: switch id Value: list of OpenFlow messages waiting for flush_msgs
+        self.send_queue = {}
+        # Key: tuple(switch id, match fields) Value: time the flow was last sent, oldest first
+        self.flow_cache = collections.OrderedDict()
+
+        # ARP frames only differ in the target addresses, which are patched in before sending
+        self._arp_req_ext_tmpl = _build_arp_frame(arp.ARP_REQUEST, config.nat_external_mac,
+                                                  config.nat_external_ip)
+        self._arp_req_int_tmpl = _build_arp_frame(arp.ARP_REQUEST, config.nat_internal_mac,
+                                                  config.nat_internal_ip)
+        # Key: IP the reply answers for Value: reply frame template
+        self._arp_reply_tmpl = {
+            config.nat_internal_ip: _build_arp_frame(arp.ARP_REPLY, config.nat_internal_mac,
+                                                     config.nat_internal_ip),
+            config.nat_external_ip: _build_arp_frame(arp.ARP_REPLY, config.nat_external_mac,
+                                                     config.nat_external_ip),
+        }
+
+        self.threads.append(hub.spawn(self.sweep_pending_arp))
+
+
+    @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
+    def handle_switch_features(self, event):
+        '''
+        A (re)connected switch starts with empty group and flow tables, so anything
+        remembered as installed on it is forgotten.
+        '''
+        switch = event.msg.datapath
+        self.gateway_groups.pop(switch.id, None)
+        for key in [key for key in self.flow_cache if key[0] == switch.id]:
+            del self.flow_cache[key]
+        # No flow removed message will come for the lost reply flows. Mappings still in use
+        # get them back on their next packet-in, the others expire after nat_entry_ttl.
+        for nat_flow in self.nat_flows.values():
+            nat_flow.peers.clear()
+            nat_flow.remotes.clear()
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def handle_flow_removed(self, event):
+        '''
+        Returns the external port of a NAT mapping to the free pool once all of its reply
+        flows have idled out on the switch, and removes its outbound flows.
+        '''
+        switch = event.msg.datapath
+        match = event.msg.match
+        if match.get('ipv4_dst') != config.nat_external_ip:
+            return
+
+        protocol = match.get('ip_proto')
+        if protocol == in_proto.IPPROTO_TCP:
+            src_port, ext_port = match.get('tcp_src'), match.get('tcp_dst')
+        elif protocol == in_proto.IPPROTO_UDP:
+            src_port, ext_port = match.get('udp_src'), match.get('udp_dst')
+        else:
+            return
+
+        nat_flow = self.nat_flows.get(ext_port)
+        peer = (protocol, match['ipv4_src'], src_port)
+        if nat_flow is None or peer not in nat_flow.peers:
+            return
+
+        if event.msg.reason != switch.ofproto.OFPRR_IDLE_TIMEOUT:
+            # Deleted by the controller, which already took care of the mapping
+            return
+
+        nat_flow.peers.discard(peer)
+        if nat_flow.peers:
+            return
 
+        self.release_nat_entry(switch, ext_port)
+        self.flush_msgs()
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def handle_packet_in(self, event):
         '''Handles incoming OpenFlow packet'''
 
         of_packet = event.msg # openflow packet
-        data_packet = packet.Packet(data=of_packet.data) # decapsulated packet
+        try:
+            # Packets for the external side of the NAT are translated straight from the raw
+            # frame, without parsing it into a Ryu packet
+            if of_packet.data[_ETH_DST] == self._ext_mac_bin:
+                flow = nat_kernel.classify(of_packet.data, self.nat_flows)
+                if flow is not None:
+                    self.switch_learn(of_packet, addrconv.mac.bin_to_text(of_packet.data[_ETH_SRC]))
+                    self.handle_incoming_external_msg(of_packet, flow)
+                    return
+
+            data_packet = packet.Packet(data=of_packet.data) # decapsulated packet
+            # Split the packet into its layers once; handlers get them directly
+            protocols = data_packet.protocols
+            eth = protocols[0]
+            l3 = protocols[1] if len(protocols) > 1 else None
+            l4 = protocols[2] if len(protocols) > 2 else None
+            ethertype = eth.ethertype
+
+            # Ignore IPv6 packets (not supported)
+            if ethertype == _ETH_IPV6:
+                return
 
-        # Ignore IPv6 packets (not supported)
-        if self.is_ipv6(data_packet):
-            return
-        
-        self.debug('Handling packet: %s' % data_packet)
-        self.debug('Reason: %s' % of_packet.reason)
+            self.debug('Handling packet: %s', data_packet)
+            self.debug('Reason: %s', of_packet.reason)
 
-        # Keep a record of MAC address incoming port
-        self.switch_learn(of_packet, data_packet)
+            # Keep a record of MAC address incoming port
+            self.switch_learn(of_packet, eth.src)
 
-        # Handle incoming ARP packet
-        if self.is_arp(data_packet):
-            self.handle_incoming_arp(of_packet, data_packet)
-        
-        # Handle packet with destination MAC matching NAT external router MAC
-        elif data_packet[0].dst == config.nat_external_mac:
-            self.handle_incoming_external_msg(of_packet, data_packet)
-        
-        # Handle packet from inside the internal network
-        else:
-            self.handle_incoming_internal_msg(of_packet, data_packet)
+            # Handle incoming ARP packet
+            if ethertype == _ETH_ARP:
+                self.handle_incoming_arp(of_packet, eth, l3)
 
-    def switch_learn(self, of_packet, data_packet):
+            # Only TCP and UDP packets to the NAT external router MAC are translated
+            elif eth.dst == config.nat_external_mac:
+                return
+
+            # Handle packet from inside the internal network
+            else:
+                self.handle_incoming_internal_msg(of_packet, eth, l3, l4)
+        finally:
+            # Send the flows and packets produced while handling this packet in one write
+            self.flush_msgs()
+
+    def switch_learn(self, of_packet, src_mac):
         '''Add entry in list of known MAC address to forward to specific links'''
         in_port = of_packet.match['in_port']
-        src_mac = data_packet[0].src
 
         self.switch_table[src_mac] = in_port
 
-    def switch_forward(self, of_packet, data_packet, actions=None):
+    def switch_forward(self, of_packet, eth, actions=None):
         '''Forward to appropriate port (or flood) based on destination MAC address'''
         switch_id = of_packet.datapath.id
-        dst_mac = data_packet[0].dst
+        dst_mac = eth.dst
 
-        if dst_mac in self.switch_table:
-            dst_port = self.switch_table[dst_mac]
-        else:
-            dst_port = of_packet.datapath.ofproto.OFPP_FLOOD
-        self.debug("forwarding packet %s" % data_packet)
+        dst_port = self.switch_table.get(dst_mac, of_packet.datapath.ofproto.OFPP_FLOOD)
+        self.debug("forwarding packet %s", eth)
         self.send_packet(of_packet.data, of_packet, dst_port, actions=actions)
 
     def router_next_hop(self, parser, src_mac, dst_mac):
-        '''Returns a list of actions performed by a router when moving from one hop to the next'''
-        
-        return [parser.OFPActionDecNwTtl(), # Decrement network-layer TTL
-                parser.OFPActionSetField(eth_src=src_mac),
-                parser.OFPActionSetField(eth_dst=dst_mac)]
+        '''
+        Returns a list of actions performed by a router when moving from one hop to the next.
+        The list is shared between calls and must not be modified.
+        '''
+        key = (src_mac, dst_mac, id(parser))
+        actions = self._next_hop_cache.get(key)
+        if actions is None:
+            actions = [parser.OFPActionDecNwTtl(), # Decrement network-layer TTL
+                       parser.OFPActionSetField(eth_src=src_mac),
+                       parser.OFPActionSetField(eth_dst=dst_mac)]
+            self._next_hop_cache[key] = actions
+        return actions
         
-    def router_forward(self, of_packet, data_packet, next_ip,
+    def router_forward(self, of_packet, eth, next_ip,
                        match=None, extra_actions=None):
         '''
         Forward to appropriate port based on destination IP address. If
@@ -92,24 +275,64 @@ class NatController(app_manager.RyuApp):
         for any future matching packet.
         '''
         
-        if next_ip not in self.arp_table:
-            self.send_arp_request(next_ip, of_packet, match, extra_actions)
+        dst_mac = self.arp_table.get(next_ip)
+        if dst_mac is None:
+            self.send_arp_request(next_ip, of_packet, eth, match, extra_actions)
             return
-        dst_mac = self.arp_table[next_ip]
-        src_mac = config.nat_external_mac if next_ip == config.nat_gateway_ip \
+        src_mac = config.nat_external_mac if next_ip == self._gw_i \
                   else config.nat_internal_mac
         
-        parser = of_packet.datapath.ofproto_parser
-        actions = self.router_next_hop(parser, src_mac, dst_mac)
-        if extra_actions:
-            actions += extra_actions
+        switch = of_packet.datapath
+        parser = switch.ofproto_parser
 
-        self.switch_forward(of_packet, data_packet, actions)
+        # Once the gateway's port is known, flows towards it reference the gateway group
+        # instead of carrying the next hop actions themselves
+        gateway_port = self.switch_table.get(dst_mac) if next_ip == self._gw_i else None
+        if gateway_port is not None:
+            group_id = self.gateway_group(switch, dst_mac, gateway_port)
+            actions = (extra_actions or []) + [parser.OFPActionGroup(group_id)]
+            self.send_packet(of_packet.data, of_packet, None, actions)
+            if match is not None:
+                self.add_flow(switch, match, actions)
+            return
+
+        # Copy the cached next hop actions: send_packet appends the output action
+        actions = self.router_next_hop(parser, src_mac, dst_mac) + (extra_actions or [])
+
+        self.switch_forward(of_packet, eth, actions)
 
         # This runs after switch_forward so that the output action is included.
         if match is not None:
-            self.add_flow(of_packet.datapath, match, actions)
-            
+            self.add_flow(switch, match, actions)
+
+    def gateway_group(self, switch, gateway_mac, gateway_port):
+        '''
+        Returns the id of the indirect group sending packets to the gateway (decrement TTL,
+        rewrite MACs, output), adding or updating it on the switch if the gateway changed.
+        '''
+        installed = self.gateway_groups.get(switch.id)
+        if installed == (gateway_mac, gateway_port):
+            return _GATEWAY_GROUP_ID
+
+        ofproto = switch.ofproto
+        parser = switch.ofproto_parser
+        actions = self.router_next_hop(parser, config.nat_external_mac, gateway_mac) + \
+                  [parser.OFPActionOutput(gateway_port)]
+        buckets = [parser.OFPBucket(actions=actions)]
+        if installed is None:
+            # Clear any group left on the switch by a previous controller run
+            self.queue_msg(switch, parser.OFPGroupMod(switch, command=ofproto.OFPGC_DELETE,
+                                                      group_id=_GATEWAY_GROUP_ID, buckets=[]))
+            command = ofproto.OFPGC_ADD
+        else:
+            command = ofproto.OFPGC_MODIFY
+        self.queue_msg(switch, parser.OFPGroupMod(switch, command=command,
+                                                  type_=ofproto.OFPGT_INDIRECT,
+                                                  group_id=_GATEWAY_GROUP_ID,
+                                                  buckets=buckets))
+        self.gateway_groups[switch.id] = (gateway_mac, gateway_port)
+        return _GATEWAY_GROUP_ID
+
     def send_packet(self, payload, of_packet, port, actions=None):
         '''Send a packet to the switch for processing/forwarding'''
         
@@ -127,215 +350,189 @@ class NatController(app_manager.RyuApp):
                                   in_port=of_packet.match['in_port'],
                                   actions=actions,
                                   data=payload)
-        switch.send_msg(out)
+        self.queue_msg(switch, out)
 
-    def add_flow(self, switch, match, actions):
-        '''Send a new flow (match+action) to be added to a switch OpenFlow table'''
+    def add_flow(self, switch, match, actions, idle_timeout=None, hard_timeout=None):
+        '''
+        Send a new flow (match+action) to be added to a switch OpenFlow table. A flow with the
+        same match sent less than flow_cache_ttl seconds ago is not sent again. idle_timeout
+        and hard_timeout default to flow_idle_timeout and flow_hard_timeout.
+        '''
+        if idle_timeout is None:
+            idle_timeout = config.flow_idle_timeout
+        if hard_timeout is None:
+            hard_timeout = config.flow_hard_timeout
+
+        key = (switch.id, tuple(match.items()))
+        now = time.monotonic()
+        sent = self.flow_cache.get(key)
+        if sent is not None and now - sent < config.flow_cache_ttl:
+            return
+        self.flow_cache[key] = now
+        self.flow_cache.move_to_end(key)
+        if len(self.flow_cache) > config.flow_cache_size:
+            self.flow_cache.popitem(last=False)
 
         self.debug('Adding a new flow:')
-        self.debug(' - match: %s' % match)
-        self.debug(' - actions: %s' % actions)
+        self.debug(' - match: %s', match)
+        self.debug(' - actions: %s', actions)
         ofproto = switch.ofproto
         parser = switch.ofproto_parser
         
         instructions = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
         modification = parser.OFPFlowMod(switch,
+                                         idle_timeout=idle_timeout,
+                                         hard_timeout=hard_timeout,
+                                         flags=ofproto.OFPFF_SEND_FLOW_REM,
                                          match=match,
                                          instructions=instructions)
-        switch.send_msg(modification)
+        self.queue_msg(switch, modification)
+
+    def queue_msg(self, switch, msg):
+        '''Queue an OpenFlow message to be sent to the switch on the next flush_msgs'''
+        self.send_queue.setdefault(switch.id, []).append(msg)
+
+    def flush_msgs(self):
+        '''Serialize the queued OpenFlow messages and send them in a single write per switch'''
+        # Take the queue before sending: send() may yield to another thread that queues or
+        # flushes messages of its own
+        send_queue, self.send_queue = self.send_queue, {}
+        for msgs in send_queue.values():
+            switch = msgs[0].datapath
+            bufs = []
+            for msg in msgs:
+                switch.set_xid(msg)
+                msg.serialize()
+                bufs.append(msg.buf)
+            switch.send(b''.join(bufs))
         
-    def handle_incoming_arp(self, of_packet, data_packet):
+    def handle_incoming_arp(self, of_packet, eth, arp_packet):
         '''Handles incoming ARP packet: update ARP table and send replies to suitable requests'''
         
-        arp_src_ip = data_packet[1].src_ip
-        arp_src_mac = data_packet[1].src_mac
+        arp_src_ip = _ip_to_int(arp_packet.src_ip)
+        arp_src_mac = arp_packet.src_mac
         self.arp_table[arp_src_ip] = arp_src_mac
 
         # For any packets waiting for this ARP reply to arrive, re-forward them
-        if arp_src_ip in self.pending_arp:
-            for of_packet, match, actions in self.pending_arp[arp_src_ip]:
-                self.router_forward(of_packet, packet.Packet(data=of_packet.data), arp_src_ip,
+        pending = self.pending_arp.pop(arp_src_ip, None)
+        if pending is not None:
+            for _, pending_packet, pending_eth, match, actions in pending:
+                self.router_forward(pending_packet, pending_eth, arp_src_ip,
                                     match=match, extra_actions=actions)
-            del self.pending_arp[arp_src_ip]
         
-        self.switch_forward(of_packet, data_packet)
+        self.switch_forward(of_packet, eth)
         
-        if data_packet[1].opcode == 1:
+        if arp_packet.opcode == 1:
             # ARP request
             self.debug("~~~~sending arp reply")
-            self.send_arp_reply(of_packet, data_packet)
+            self.send_arp_reply(of_packet, arp_packet)
 
 
-    def send_arp_request(self, ip, of_packet, match, actions):
-        '''Send an ARP request for an IP with unknown MAC address'''
+    def send_arp_request(self, ip, of_packet, eth, match, actions):
+        '''
+        Send an ARP request for an IP with unknown MAC address. Once the reply arrives the
+        packet is passed back to router_forward.
+        '''
 
-        self.debug('sending ARP request: IP %s' % ip)
+        self.debug('sending ARP request: IP %s', _int_to_ip(ip))
 
-        entry = (of_packet, match, actions)
+        entry = (time.monotonic(), of_packet, eth, match, actions)
         # If there is another pending ARP request, don't send it again.
-        if ip in self.pending_arp:
-            self.pending_arp[ip].append(entry)
+        # Once arp_pending_max packets are waiting, the oldest ones are dropped.
+        pending = self.pending_arp.get(ip)
+        if pending is not None:
+            pending.append(entry)
             return
         # Save packet so it's sent back again once ARP reply returns
-        self.pending_arp[ip] = [entry]
-        
-        if ip == config.nat_gateway_ip:
-            src_mac = config.nat_external_mac
-            src_ip = config.nat_external_ip
+        self.pending_arp[ip] = collections.deque([entry], maxlen=config.arp_pending_max)
+        self.emit_arp_request(ip, of_packet)
+
+    def emit_arp_request(self, ip, of_packet):
+        '''Floods an ARP request for ip out of the switch that received of_packet'''
+        if ip == self._gw_i:
+            arp_frame = bytearray(self._arp_req_ext_tmpl)
         else:
-            src_mac = config.nat_internal_mac
-            src_ip = config.nat_internal_ip
-        
-        eth_packet = ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', # Broadcast
-                                       src=src_mac,
-                                       ethertype=ether.ETH_TYPE_ARP)
-        arp_packet = arp.arp(hwtype=1,
-                             proto=ether.ETH_TYPE_IP,
-                             hlen=6,
-                             plen=4,
-                             opcode=arp.ARP_REQUEST,
-                             src_mac=src_mac,
-                             src_ip=src_ip,
-                             dst_mac='00:00:00:00:00:00',
-                             dst_ip=ip)
-        new_packet = packet.Packet()
-        new_packet.add_protocol(eth_packet)
-        new_packet.add_protocol(arp_packet)
-        new_packet.serialize()
-        self.send_packet(new_packet, of_packet, of_packet.datapath.ofproto.OFPP_FLOOD)
-            
-    def send_arp_reply(self, of_packet, data_packet):
+            arp_frame = bytearray(self._arp_req_int_tmpl)
+        arp_frame[_ARP_DST_IP] = _IPV4.pack(ip)
+        self.send_packet(bytes(arp_frame), of_packet, of_packet.datapath.ofproto.OFPP_FLOOD)
+
+    def sweep_pending_arp(self):
+        '''
+        Periodically drops packets that have waited longer than arp_pending_timeout for an
+        ARP reply, and asks again for IPs that still have packets waiting.
+        '''
+        while True:
+            hub.sleep(config.arp_pending_timeout / 2)
+            now = time.monotonic()
+            for ip, pending in list(self.pending_arp.items()):
+                while pending and now - pending[0][0] >= config.arp_pending_timeout:
+                    pending.popleft()
+                if pending:
+                    self.emit_arp_request(ip, pending[-1][1])
+                else:
+                    del self.pending_arp[ip]
+            self.flush_msgs()
+
+    def send_arp_reply(self, of_packet, arp_packet):
         '''Builds and sends an ARP reply, if the IP corresponds to the switch'''
         
-        arp_dst_ip = data_packet[1].dst_ip
-        if arp_dst_ip == config.nat_internal_ip:
-            arp_dst_mac = config.nat_internal_mac
-        elif arp_dst_ip == config.nat_external_ip:
-            arp_dst_mac = config.nat_external_mac
-        else:
+        arp_dst_ip = arp_packet.dst_ip
+        arp_template = self._arp_reply_tmpl.get(arp_dst_ip)
+        if arp_template is None:
             return
 
-        self.debug('Sending ARP reply: %s -> %s' % (arp_dst_ip, arp_dst_mac))
-        eth_packet = ethernet.ethernet(dst=data_packet[1].src_mac,
-                                       src=arp_dst_mac,
-                                       ethertype=ether.ETH_TYPE_ARP)
-        arp_packet = arp.arp(hwtype=1,
-                             proto=ether.ETH_TYPE_IP,
-                             hlen=6,
-                             plen=4,
-                             opcode=arp.ARP_REPLY,
-                             src_mac=arp_dst_mac,
-                             src_ip=arp_dst_ip,
-                             dst_mac=data_packet[1].src_mac,
-                             dst_ip=data_packet[1].src_ip)
-        new_packet = packet.Packet()
-        new_packet.add_protocol(eth_packet)
-        new_packet.add_protocol(arp_packet)
-        new_packet.serialize()
-        self.debug('ARP reply: %s' % new_packet)
-        self.send_packet(new_packet, of_packet, of_packet.datapath.ofproto.OFPP_IN_PORT)
-
-    def is_arp(self, packet):
-        return packet[0].ethertype == 2054
-
-    def is_ipv4(self, packet):
-        return packet[0].ethertype == 2048
-
-    def is_icmp(self, packet):
-        return packet[1].proto == 1
-
-    def is_tcp(self, packet):
-        return packet[1].proto == 6
-
-    def is_udp(self, packet):
-        return packet[1].proto == 17
-
-    def is_ipv6(self, packet):
-        return packet[0].ethertype == 34525
+        self.debug('Sending ARP reply: %s -> %s', arp_packet.src_ip, arp_dst_ip)
+        requester_mac = addrconv.mac.text_to_bin(arp_packet.src_mac)
+        arp_frame = bytearray(arp_template)
+        arp_frame[_ETH_DST] = requester_mac
+        arp_frame[_ARP_DST_MAC] = requester_mac
+        arp_frame[_ARP_DST_IP] = socket.inet_aton(arp_packet.src_ip)
+        self.send_packet(bytes(arp_frame), of_packet, of_packet.datapath.ofproto.OFPP_IN_PORT)
 
     def is_internal_network(self, ip):
-        return ipaddress.ip_address(ip) in ipaddress.ip_network(config.nat_internal_net)
+        '''Returns whether an integer IP address is in the internal network'''
+        return (ip & self._int_mask) == self._int_net
+
+    def handle_incoming_external_msg(self, of_packet, flow):
+        '''
+        Handles a TCP/UDP packet with destination MAC equal to external side of NAT router.
+        flow is the tuple returned by nat_kernel.classify.
+        '''
+        protocol, src_port, port_nat, src_ip, dst_ip, nat_flow = flow
+        if nat_flow is None:
+            # drop packet if no NAT entry
+            return
 
-    def handle_incoming_external_msg(self, of_packet, data_packet):
-        '''Handles a packet with destination MAC equal to external side of NAT router.'''
         switch = of_packet.datapath
         ofproto = switch.ofproto
         parser = switch.ofproto_parser
 
-        eth = data_packet.get_protocols(ethernet.ethernet)[0]
-        dst_mac = eth.dst
-        src_mac = eth.src
-
-        if self.is_ipv4(data_packet):
-            ip = data_packet.get_protocol(ipv4.ipv4)
-            src_ip = ip.src
-            dst_ip = ip.dst
-            protocol = ip.proto
-            port_nat = 0
-            
-            if protocol == in_proto.IPPROTO_TCP:
-                self.debug("external TCP packet received")
-                tcp_proto = data_packet.get_protocol(tcp.tcp)
-                port_nat = tcp_proto.dst_port
-                
-            elif protocol == in_proto.IPPROTO_UDP:
-                self.debug("external UDP packet received")
-                udp_proto = data_packet.get_protocol(udp.udp)
-                port_nat = udp_proto.dst_port
-            else:
-                return
-            if port_nat == 0 or str(port_nat) not in self.nat_translation:
-                # drop packet if no NAT entry
-                return
-            self.debug("~~~~handling external->internal")
-            # Outside -> Inside
-            '''
-            For TCP or UDP messages originating in the external network with a destination IP 
-            linked to the NAT network, perform the appropriate changes in the message to deliver 
-            it to its intended destination. 
-            '''
-            # Swap src IP to external side of NAT router then send the packet
-            # TCP and UDP: Translate using nat rules and forwarded
-            nat_entry = self.nat_translation[str(port_nat)]
-            internal_ip_addr = nat_entry[0]
-            internal_port = nat_entry[1]
-
-            if internal_ip_addr not in self.arp_table:
-                self.send_arp_request(internal_ip_addr, of_packet, None, None)
-                # todo needed?
-                time.sleep(1)
-            
-            internal_host_mac = self.arp_table[internal_ip_addr]
-
-            if internal_host_mac in self.switch_table:
-                out_port = self.switch_table[internal_host_mac]
-
-            if protocol == in_proto.IPPROTO_TCP:
-                match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, 
-                                        ipv4_dst=dst_ip, ip_proto=protocol, tcp_src=tcp_proto.src_port, tcp_dst=tcp_proto.dst_port)
-                
-                actions = [parser.OFPActionSetField(ipv4_dst=internal_ip_addr),
-                    parser.OFPActionSetField(tcp_dst=internal_port),
-                    parser.OFPActionSetField(eth_src=config.nat_internal_mac),
-                    parser.OFPActionSetField(eth_dst=internal_host_mac),
-                    parser.OFPActionOutput(out_port)]
-                
-            elif protocol == in_proto.IPPROTO_UDP:
-                match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip, 
-                                        ip_proto=protocol, udp_src=udp_proto.src_port, udp_dst=udp_proto.dst_port)
-                
-                actions = [parser.OFPActionSetField(ipv4_dst=internal_ip_addr),
-                    parser.OFPActionSetField(udp_dst=internal_port),
-                    parser.OFPActionSetField(eth_src=config.nat_internal_mac),
-                    parser.OFPActionSetField(eth_dst=internal_host_mac),
-                    parser.OFPActionOutput(out_port)]
-                    
-            self.add_flow(switch, match, actions)
-            self.switch_forward(of_packet, data_packet, actions)
-
-
-    def handle_incoming_internal_msg(self, of_packet, data_packet):
-        '''Handles a packet with destination MAC equal to internal side of NAT router.'''
+        self.debug("~~~~handling external->internal")
+        # Outside -> Inside
+        '''
+        For TCP or UDP messages originating in the external network with a destination IP 
+        linked to the NAT network, perform the appropriate changes in the message to deliver 
+        it to its intended destination. 
+        '''
+        # Swap src IP to external side of NAT router then send the packet
+        # TCP and UDP: Translate using nat rules and forwarded
+        # The mapping already knows where the internal host is, no ARP/switch lookups needed
+        self.touch_nat_entry(port_nat, nat_flow, time.monotonic())
+        nat_flow.peers.add((protocol, src_ip, src_port))
+        match, actions = self.nat_reply_flow(parser, protocol, nat_flow, src_ip, src_port,
+                                             port_nat)
+        # Reply flows only idle out, which is what releases the NAT mapping
+        self.add_flow(switch, match, actions, idle_timeout=config.nat_entry_ttl,
+                      hard_timeout=0)
+        # actions already end with the output to the internal host
+        self.send_packet(of_packet.data, of_packet, None, actions)
+
+
+    def handle_incoming_internal_msg(self, of_packet, eth, ip, l4):
+        '''
+        Handles a packet with destination MAC equal to internal side of NAT router.
+        eth, ip and l4 are the packet's first three protocol layers (ip and l4 may be None).
+        '''
         self.debug("In handling incoming internal msg")
         # ORIGINATES INSIDE
         '''
@@ -346,26 +543,19 @@ class NatController(app_manager.RyuApp):
         ofproto = switch.ofproto
         parser = switch.ofproto_parser
 
-        eth = data_packet.get_protocols(ethernet.ethernet)[0]
         dst_mac = eth.dst
         src_mac = eth.src
-        out_port = None
-
 
-        if dst_mac in self.switch_table:
-            out_port = self.switch_table[dst_mac]
-        else:
-            out_port = of_packet.datapath.ofproto.OFPP_FLOOD
+        out_port = self.switch_table.get(dst_mac, ofproto.OFPP_FLOOD)
 
-        if (self.is_ipv4(data_packet)):
-            ip = data_packet.get_protocol(ipv4.ipv4)
+        if eth.ethertype == _ETH_IP:
             src_ip = ip.src
             dst_ip = ip.dst
             protocol = ip.proto
 
-            self.debug("src:%s\ndst:%s\nprotocol:%s" %(src_ip, dst_ip, protocol))
+            self.debug("src:%s\ndst:%s\nprotocol:%s", src_ip, dst_ip, protocol)
 
-            if (self.is_internal_network(dst_ip)):
+            if (self.is_internal_network(_ip_to_int(dst_ip))):
                 self.debug("~~~~handling internal->internal")
                 actions = [parser.OFPActionOutput(out_port)]
 
@@ -375,16 +565,18 @@ class NatController(app_manager.RyuApp):
 
                 #  if TCP Protocol
                 elif protocol == in_proto.IPPROTO_TCP:
-                    tcp_proto = data_packet.get_protocol(tcp.tcp)
-                    match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip, ip_proto=protocol, tcp_src=tcp_proto.src_port, tcp_dst=tcp_proto.dst_port)
+                    tcp_proto = l4
+                    match = _MATCH_BUILDERS[protocol](parser, src_ip, dst_ip, tcp_proto.src_port, tcp_proto.dst_port)
             
                 #  If UDP Protocol 
                 elif protocol == in_proto.IPPROTO_UDP:
-                    udp_proto = data_packet.get_protocol(udp.udp)
-                    match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip, ip_proto=protocol, udp_src=udp_proto.src_port, udp_dst=udp_proto.dst_port)
+                    udp_proto = l4
+                    match = _MATCH_BUILDERS[protocol](parser, src_ip, dst_ip, udp_proto.src_port, udp_proto.dst_port)
                 
                 self.add_flow(switch, match, actions)
-                self.switch_forward(of_packet, data_packet, actions)
+                # actions already end with the output; the flow is only serialized on flush,
+                # so the list must not get another output appended
+                self.send_packet(of_packet.data, of_packet, None, actions)
             
             # Packet destination is outside of the network
             # elif arp_dst_ip == config.nat_external_ip:
@@ -394,40 +586,147 @@ class NatController(app_manager.RyuApp):
             else:
                 self.debug("~~~handle internal->external")
                 if protocol == in_proto.IPPROTO_TCP:
-                    tcp_proto = data_packet.get_protocol(tcp.tcp)
+                    tcp_proto = l4
                     internal_src_port = tcp_proto.src_port
-                    internal_src_addr = src_ip
+                    internal_src_addr = _ip_to_int(src_ip)
 
-                    entry = (internal_src_addr, internal_src_port)
-                    ext_port = self.add_nat_entry(entry) 
-                    match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip, ip_proto=protocol, tcp_src=tcp_proto.src_port, tcp_dst=tcp_proto.dst_port)
+                    ext_port = self.add_nat_entry(switch, internal_src_addr, internal_src_port,
+                                                  src_mac, of_packet.match['in_port'])
+                    match = _MATCH_BUILDERS[protocol](parser, src_ip, dst_ip, tcp_proto.src_port, tcp_proto.dst_port)
+                    # router_forward adds the next hop towards the gateway
                     actions = [parser.OFPActionSetField(ipv4_src=config.nat_external_ip),
-                       parser.OFPActionSetField(tcp_src=ext_port),
-                       parser.OFPActionSetField(eth_src=config.nat_external_mac),
-                       parser.OFPActionOutput(out_port)]
+                       parser.OFPActionSetField(tcp_src=ext_port)]
 
                 elif protocol == in_proto.IPPROTO_UDP:
-                    udp_proto = data_packet.get_protocol(udp.udp)
+                    udp_proto = l4
                     internal_src_port = udp_proto.src_port
-                    internal_src_addr = src_ip
+                    internal_src_addr = _ip_to_int(src_ip)
 
-                    entry = (internal_src_addr, internal_src_port)
-                    ext_port = self.add_nat_entry(entry) 
+                    ext_port = self.add_nat_entry(switch, internal_src_addr, internal_src_port,
+                                                  src_mac, of_packet.match['in_port'])
                     
-                    match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP, ipv4_src=src_ip, ipv4_dst=dst_ip, ip_proto=protocol, udp_src=udp_proto.src_port, udp_dst=udp_proto.dst_port)
+                    match = _MATCH_BUILDERS[protocol](parser, src_ip, dst_ip, udp_proto.src_port, udp_proto.dst_port)
+                    # router_forward adds the next hop towards the gateway
                     actions = [parser.OFPActionSetField(ipv4_src=config.nat_external_ip),
-                       parser.OFPActionSetField(udp_src=ext_port),
-                       parser.OFPActionSetField(eth_src=config.nat_external_mac),
-                       parser.OFPActionOutput(out_port)]
+                       parser.OFPActionSetField(udp_src=ext_port)]
+
+                # Replies are translated back by the switch without another packet-in
+                nat_flow = self.nat_flows[ext_port]
+                nat_flow.peers.add((protocol, dst_ip, l4.dst_port))
+                nat_flow.remotes.add((protocol, dst_ip, l4.dst_port))
+                reverse_match, reverse_actions = self.nat_reply_flow(parser, protocol, nat_flow,
+                                                                     dst_ip, l4.dst_port, ext_port)
+                self.add_flow(switch, reverse_match, reverse_actions,
+                              idle_timeout=config.nat_entry_ttl, hard_timeout=0)
+                # router_forward installs the outbound flow, including the next hop actions
+                self.router_forward(of_packet, eth, self._gw_i, match, actions)
+
+    def nat_reply_flow(self, parser, protocol, nat_flow, remote_ip, remote_port, ext_port):
+        '''
+        Returns the match and actions of the flow translating replies from
+        (remote_ip, remote_port) to ext_port back to the internal host of nat_flow
+        '''
+        match = _MATCH_BUILDERS[protocol](parser, remote_ip, config.nat_external_ip,
+                                          remote_port, ext_port)
+        if protocol == in_proto.IPPROTO_TCP:
+            l4_dst = parser.OFPActionSetField(tcp_dst=nat_flow.internal_port)
+        else:
+            l4_dst = parser.OFPActionSetField(udp_dst=nat_flow.internal_port)
+        actions = [parser.OFPActionSetField(ipv4_dst=_int_to_ip(nat_flow.internal_ip)),
+                   l4_dst,
+                   parser.OFPActionSetField(eth_src=config.nat_internal_mac),
+                   parser.OFPActionSetField(eth_dst=nat_flow.mac),
+                   parser.OFPActionOutput(nat_flow.port)]
+        return match, actions
+
+    def debug(self, msg, *args):
+        '''Print a debug message if enabled; msg is only formatted with args when printed'''
+        if config.nat_debug:
+            print(msg % args if args else msg)
+
+    def add_nat_entry(self, switch, internal_ip, internal_port, mac, port):
+        '''
+        Returns the external port mapped to (internal_ip, internal_port), allocating one if
+        needed. mac and port locate the internal host on switch.
+        '''
+        now = time.monotonic()
+        internal_entry = (internal_ip, internal_port)
+        cur_port = self.rev_nat.get(internal_entry)
+        if cur_port is not None:
+            nat_flow = self.nat_flows[cur_port]
+            nat_flow.mac = mac
+            nat_flow.port = port
+            self.touch_nat_entry(cur_port, nat_flow, now)
+            return cur_port
+
+        self.expire_nat_entries(switch, now)
+        if len(self.nat_flows) >= config.nat_max_entries or not self.free_ports:
+            # Table is full: evict the least recently used mapping, flows included
+            self.release_nat_entry(switch, next(iter(self.nat_flows)))
+        cur_port = self.free_ports.pop()
+
+        self.nat_flows[cur_port] = FlowState(internal_ip, internal_port, mac, port, now)
+        self.rev_nat[internal_entry] = cur_port
+        return cur_port
 
-                self.add_flow(switch, match, actions)
-                self.router_forward(of_packet, data_packet, config.nat_gateway_ip, match, actions)
+    def touch_nat_entry(self, port, nat_flow, now):
+        '''Marks the NAT mapping of an external port as recently used'''
+        nat_flow.ts = now
+        self.nat_flows.move_to_end(port)
 
-    def debug(self, str):
-        print(str)
+    def remove_nat_entry(self, port):
+        '''Drops the NAT mapping for an external port'''
+        nat_flow = self.nat_flows.pop(port)
+        del self.rev_nat[(nat_flow.internal_ip, nat_flow.internal_port)]
 
-    def add_nat_entry(self, internal_entry):
-        cur_port = self.nat_port
-        self.nat_translation[str(cur_port)] = internal_entry
-        self.nat_port = self.nat_port + 1
-        return cur_port
+    def release_nat_entry(self, switch, port):
+        '''
+        Drops the NAT mapping for an external port together with its outbound and reply
+        flows on switch, and returns the port to the far end of the free pool
+        '''
+        self.debug('Releasing NAT port %s', port)
+        nat_flow = self.nat_flows[port]
+        self.remove_nat_entry(port)
+        self.free_ports.appendleft(port)
+
+        # Outbound flows still rewrite to the released port; the next packet gets a new one
+        ofproto = switch.ofproto
+        parser = switch.ofproto_parser
+        internal_ip = _int_to_ip(nat_flow.internal_ip)
+        # Only the mapping's own outbound flows: internal flows of the same host and port
+        # are left alone
+        matches = [_MATCH_BUILDERS[protocol](parser, internal_ip, remote_ip,
+                                             nat_flow.internal_port, remote_port)
+                   for protocol, remote_ip, remote_port in nat_flow.remotes]
+        for protocol, l4_dst in ((in_proto.IPPROTO_TCP, 'tcp_dst'),
+                                 (in_proto.IPPROTO_UDP, 'udp_dst')):
+            matches.append(parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP,
+                                           ipv4_dst=config.nat_external_ip,
+                                           ip_proto=protocol, **{l4_dst: port}))
+        stale = []
+        for match in matches:
+            self.queue_msg(switch, parser.OFPFlowMod(switch, command=ofproto.OFPFC_DELETE,
+                                                     out_port=ofproto.OFPP_ANY,
+                                                     out_group=ofproto.OFPG_ANY,
+                                                     match=match))
+            stale.append(set(match.items()))
+
+        # Deleted flows must not be skipped as duplicates if they are needed again soon
+        for key in [key for key in self.flow_cache if key[0] == switch.id and
+                    any(fields.issubset(key[1]) for fields in stale)]:
+            del self.flow_cache[key]
+
+    def expire_nat_entries(self, switch, now):
+        '''
+        Reclaims the ports of NAT mappings unused for longer than nat_entry_ttl. Mappings
+        with reply flows on the switch are released when those flows idle out instead.
+        '''
+        while self.nat_flows:
+            port, nat_flow = next(iter(self.nat_flows.items()))
+            if now - nat_flow.ts < config.nat_entry_ttl:
+                break
+            if nat_flow.peers:
+                # Possibly still in use on the fast path, without packet-ins
+                self.touch_nat_entry(port, nat_flow, now)
+            else:
+                self.release_nat_entry(switch, port)
@@ -0,0 +1,43 @@
+# Classification of packets arriving at the external side of the NAT, working
+# directly on the raw frame instead of going through Ryu's packet library
+
+import socket
+import struct
+
+from ryu.lib.packet import in_proto
+
+_ETH_TYPE_IP = 0x0800
+_ETH_HEADER_LEN = 14
+
+# IPv4 header: version/IHL, flags/fragment offset, protocol, source, destination
+_IPV4_HEADER = struct.Struct('!B5xHxB2x4s4s')
+_IPV4_FRAG_OFFSET = 0x1fff
+# TCP and UDP both start with source port, destination port
+_L4_PORTS = struct.Struct('!HH')
+
+def classify(data, nat_map):
+    '''
+    Parses an Ethernet/IPv4/TCP or UDP frame and probes nat_map (external port -> NAT
+    mapping) with its destination port. Returns a tuple
+    (proto, src_port, dst_port, src_ip, dst_ip, nat_entry), where nat_entry is None if
+    there is no mapping for the port, or None if the frame is not an unfragmented
+    IPv4 TCP/UDP packet.
+    '''
+    if len(data) < _ETH_HEADER_LEN + _IPV4_HEADER.size or \
+       data[12] << 8 | data[13] != _ETH_TYPE_IP:
+        return None
+
+    ver_ihl, frag, proto, src_ip, dst_ip = _IPV4_HEADER.unpack_from(data, _ETH_HEADER_LEN)
+    if proto != in_proto.IPPROTO_TCP and proto != in_proto.IPPROTO_UDP:
+        return None
+    if frag & _IPV4_FRAG_OFFSET:
+        # Only the first fragment carries the ports
+        return None
+
+    l4_offset = _ETH_HEADER_LEN + (ver_ihl & 0x0f) * 4
+    if len(data) < l4_offset + _L4_PORTS.size:
+        return None
+    src_port, dst_port = _L4_PORTS.unpack_from(data, l4_offset)
+
+    return (proto, src_port, dst_port, socket.inet_ntoa(src_ip), socket.inet_ntoa(dst_ip),
+            nat_map.get(dst_port))
@@ -0,0 +1,112 @@
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.controller import ofp_event
+from ryu.lib.packet import packet, ethernet, ether_types, ipv4, tcp, in_proto
+from ryu.ofproto import ofproto_protocol, ofproto_v1_2
+
+import nat_config as config
+import nat_controller
+
+HOST_MAC = '00:00:00:00:00:01'
+HOST_IP = '192.168.0.1'
+HOST_PORT = 40000
+REMOTE_IP = '8.8.8.8'
+REMOTE_PORT = 80
+
+
+class FakeSwitch(ofproto_protocol.ProtocolDesc):
+    '''Datapath keeping the messages sent to it instead of writing them to a socket'''
+    def __init__(self):
+        super().__init__(ofproto_v1_2.OFP_VERSION)
+        self.id = 1
+        self.sent = []
+
+    def set_xid(self, msg):
+        msg.set_xid(len(self.sent))
+        self.sent.append(msg)
+
+    def send(self, buf):
+        pass
+
+
+def outbound_packet_in(switch):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=config.nat_internal_mac, src=HOST_MAC,
+                                       ethertype=ether_types.ETH_TYPE_IP))
+    pkt.add_protocol(ipv4.ipv4(src=HOST_IP, dst=REMOTE_IP, proto=in_proto.IPPROTO_TCP))
+    pkt.add_protocol(tcp.tcp(src_port=HOST_PORT, dst_port=REMOTE_PORT))
+    pkt.serialize()
+    parser = switch.ofproto_parser
+    msg = parser.OFPPacketIn(switch, buffer_id=switch.ofproto.OFP_NO_BUFFER,
+                             total_len=len(pkt.data), reason=switch.ofproto.OFPR_NO_MATCH,
+                             table_id=0, match=parser.OFPMatch(in_port=1), data=bytes(pkt.data))
+    return ofp_event.EventOFPPacketIn(msg)
+
+
+def reply_flow(switch):
+    for msg in switch.sent:
+        if isinstance(msg, switch.ofproto_parser.OFPFlowMod) and \
+           msg.command == switch.ofproto.OFPFC_ADD and \
+           msg.match.get('ipv4_dst') == config.nat_external_ip:
+            return msg
+    return None
+
+
+def flow_removed(switch, match, reason):
+    msg = switch.ofproto_parser.OFPFlowRemoved(switch, cookie=0, priority=0, reason=reason,
+                                               table_id=0, match=match)
+    return ofp_event.EventOFPFlowRemoved(msg)
+
+
+@pytest.fixture
+def nat():
+    app = nat_controller.NatController()
+    switch = FakeSwitch()
+    app.handle_packet_in(outbound_packet_in(switch))
+    return app, switch
+
+
+def test_reply_flow_only_idles_out(nat):
+    app, switch = nat
+    flow = reply_flow(switch)
+    assert flow is not None
+    # A hard timeout would always fire first and keep the mapping from being released
+    assert flow.idle_timeout == config.nat_entry_ttl
+    assert flow.hard_timeout == 0
+
+
+def test_idle_reply_flow_releases_port(nat):
+    app, switch = nat
+    flow = reply_flow(switch)
+    ext_port = flow.match['tcp_dst']
+    assert ext_port in app.nat_flows
+
+    app.handle_flow_removed(flow_removed(switch, flow.match, switch.ofproto.OFPRR_IDLE_TIMEOUT))
+    assert ext_port not in app.nat_flows
+    # Released ports are the last to be handed out again
+    assert app.free_ports[0] == ext_port
+
+
+def test_deleted_reply_flow_keeps_mapping(nat):
+    app, switch = nat
+    flow = reply_flow(switch)
+    ext_port = flow.match['tcp_dst']
+
+    app.handle_flow_removed(flow_removed(switch, flow.match, switch.ofproto.OFPRR_DELETE))
+    assert ext_port in app.nat_flows
+
+
+def test_release_only_deletes_nat_flows(nat):
+    app, switch = nat
+    flow = reply_flow(switch)
+    app.handle_flow_removed(flow_removed(switch, flow.match, switch.ofproto.OFPRR_IDLE_TIMEOUT))
+
+    deletes = [msg.match for msg in switch.sent
+               if isinstance(msg, switch.ofproto_parser.OFPFlowMod) and
+               msg.command == switch.ofproto.OFPFC_DELETE]
+    assert deletes
+    # Flows from the same host and port to internal hosts must survive
+    for match in deletes:
+        assert match.get('ipv4_dst') in (config.nat_external_ip, REMOTE_IP)